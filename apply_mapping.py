@@ -4,6 +4,9 @@ Apply the component mapping to reassociate PCB footprints with schematic symbols
 """
 
 import re
+import sys
+
+from reassociate_components import fast_re, find_block_end, finish_write, map_file, write_edits
 
 # Direct mapping: PCB_REF -> (NEW_REF, SCHEMATIC_UUID)
 MAPPING = {
@@ -57,90 +60,124 @@ MAPPING = {
     'R80': ('R171', '110cc942-f5d0-4c75-a2bb-e1d38da8302d'),
 }
 
+# Footprint header: full match, footprint name, uuid, X, Y
+FOOTPRINT_HEADER_RE = fast_re.compile(rb'(\t\(footprint "([^"]+)"\s*\n\t\t\(layer "[^"]+"\)\s*\n\t\t\(uuid "([a-f0-9-]+)"\)\s*\n\t\t\(at ([0-9.-]+) ([0-9.-]+))')
+REF_INLINE_RE = fast_re.compile(rb'\(property "Reference" "([^"]+)"')
+
+# Per-reference substitutions built once: PCB_REF -> (pattern, replacement)
+REF_SUBS = {
+    old_ref: (
+        re.compile(rb'(\(property "Reference" )"' + re.escape(old_ref.encode()) + b'"'),
+        rb'\1"' + new_ref.encode() + b'"',
+    )
+    for old_ref, (new_ref, _) in MAPPING.items()
+}
+
+
+def index_footprints(content):
+    """Index footprints in the copied area (Y < 180) whose reference is in MAPPING.
 
-def apply_mapping(pcb_file, output_file):
-    """Apply the mapping to the PCB file."""
-    with open(pcb_file, 'r', encoding='utf-8') as f:
-        content = f.read()
+    Returns {reference: [(block_start, block_end, has_path), ...]} with the
+    blocks of each reference in file order, up to and including the first
+    unlinked one (the only one apply_mapping will rewrite).
+    """
+    footprints = {}
+    
+    for match in FOOTPRINT_HEADER_RE.finditer(content):
+        y_coord = float(match.group(5))
+        
+        # Only process components in copied area (Y < 180)
+        if y_coord >= 180:
+            continue
+        
+        # The Reference property follows the header; stop at the next footprint
+        next_header = content.find(b'\n\t(footprint "', match.end())
+        if next_header == -1:
+            next_header = len(content)
+        ref_match = REF_INLINE_RE.search(content, match.end(), next_header)
+        if not ref_match:
+            continue
+        
+        # Skip references not in MAPPING, or already resolved to an unlinked
+        # block, before walking the block body
+        reference = ref_match.group(1).decode()
+        if reference not in MAPPING:
+            continue
+        entries = footprints.setdefault(reference, [])
+        if entries and not entries[-1][2]:
+            continue
+        
+        # Find the full footprint block
+        block_start = match.start()
+        block_end = find_block_end(content, block_start)
+        
+        has_path = content.find(b'(path "/', block_start, block_end) != -1
+        entries.append((block_start, block_end, has_path))
     
+    return footprints
+
+
+def format_log_entry(entry):
+    """Format a (kind, old_ref[, new_ref]) entry logged by apply_mapping."""
+    if entry[0] == 'skip':
+        return f"Skipping {entry[1]} - already linked"
+    return f"Processing {entry[1]} -> {entry[2]}"
+
+
+def apply_mapping(pcb_file, output_file, verbose=True):
+    """Apply the mapping to the PCB file.
+
+    Per-footprint progress is collected while processing and printed in one
+    write afterwards, or not at all if verbose is False.
+    """
     changes_made = 0
+    log = []
     
-    for old_ref, (new_ref, sch_uuid) in MAPPING.items():
-        # Find all footprint blocks
-        # Pattern to find footprint header with position
-        pattern = r'(\t\(footprint "([^"]+)"\s*\n\t\t\(layer "[^"]+"\)\s*\n\t\t\(uuid "([a-f0-9-]+)"\)\s*\n\t\t\(at ([0-9.-]+) ([0-9.-]+))'
+    with map_file(pcb_file) as content:
+        footprints = index_footprints(content)
+        edits = []
         
-        for match in re.finditer(pattern, content):
-            y_coord = float(match.group(5))
-            
-            # Only process components in copied area (Y < 180)
-            if y_coord >= 180:
-                continue
-            
-            # Find the full footprint block
-            block_start = match.start()
-            depth = 0
-            block_end = block_start
-            for i, char in enumerate(content[block_start:], block_start):
-                if char == '(':
-                    depth += 1
-                elif char == ')':
-                    depth -= 1
-                    if depth == 0:
-                        block_end = i + 1
-                        break
-            
-            block = content[block_start:block_end]
-            
-            # Check if this block has the reference we're looking for
-            ref_pattern = rf'\(property "Reference" "{re.escape(old_ref)}"'
-            if not re.search(ref_pattern, block):
-                continue
-            
-            # Check if already has a path (skip if already linked)
-            if re.search(r'\(path "/[a-f0-9-]+"\)', block):
-                print(f"Skipping {old_ref} - already linked")
-                continue
-            
-            print(f"Processing {old_ref} -> {new_ref}")
-            
-            new_block = block
-            
-            # 1. Change reference in property
-            new_block = re.sub(
-                rf'(\(property "Reference" )"{re.escape(old_ref)}"',
-                rf'\1"{new_ref}"',
-                new_block
-            )
-            
-            # 2. Add path, sheetname, sheetfile
-            insert_text = f'\n\t\t(path "/{sch_uuid}")\n\t\t(sheetname "/")\n\t\t(sheetfile "isoSPI-M3Y-BMS-PCB.kicad_sch")'
-            
-            # Try to find (attr ...) and insert after it
-            attr_match = re.search(r'\(attr [^\)]+\)', new_block)
-            if attr_match:
-                insert_pos = attr_match.end()
-                new_block = new_block[:insert_pos] + insert_text + new_block[insert_pos:]
-            else:
-                # Insert before first (fp_line or (fp_arc
-                fp_match = re.search(r'\n\t\t\(fp_', new_block)
-                if fp_match:
-                    insert_pos = fp_match.start()
-                    new_block = new_block[:insert_pos] + insert_text + new_block[insert_pos:]
+        for old_ref, (new_ref, sch_uuid) in MAPPING.items():
+            for block_start, block_end, has_path in footprints.get(old_ref, ()):
+                # Skip if already linked
+                if has_path:
+                    log.append(('skip', old_ref))
+                    continue
+                
+                log.append(('process', old_ref, new_ref))
+                
+                new_block = content[block_start:block_end]
+                
+                # 1. Change reference in property
+                ref_pattern, ref_replacement = REF_SUBS[old_ref]
+                new_block = ref_pattern.sub(ref_replacement, new_block, count=1)
+                
+                # 2. Add path, sheetname, sheetfile
+                insert_text = f'\n\t\t(path "/{sch_uuid}")\n\t\t(sheetname "/")\n\t\t(sheetfile "isoSPI-M3Y-BMS-PCB.kicad_sch")'.encode()
+                
+                # Try to find (attr ...) and insert after it
+                attr_pos = new_block.find(b'(attr ')
+                if attr_pos != -1:
+                    insert_pos = new_block.find(b')', attr_pos) + 1
                 else:
-                    # Insert before first (pad
-                    pad_match = re.search(r'\n\t\t\(pad ', new_block)
-                    if pad_match:
-                        insert_pos = pad_match.start()
-                        new_block = new_block[:insert_pos] + insert_text + new_block[insert_pos:]
-            
-            # Update content with new block
-            content = content[:block_start] + new_block + content[block_end:]
-            changes_made += 1
-            break  # Only process first match for this reference
-    
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(content)
+                    # Insert before first (fp_line or (fp_arc
+                    insert_pos = new_block.find(b'\n\t\t(fp_')
+                    if insert_pos == -1:
+                        # Insert before first (pad
+                        insert_pos = new_block.find(b'\n\t\t(pad ')
+                if insert_pos > 0:
+                    new_block = new_block[:insert_pos] + insert_text + new_block[insert_pos:]
+                
+                edits.append((block_start, block_end, new_block))
+                changes_made += 1
+                break  # Only process first match for this reference
+        
+        tmp_file = write_edits(content, edits, output_file)
+    
+    finish_write(tmp_file, output_file)
+    
+    if verbose and log:
+        sys.stdout.write('\n'.join(map(format_log_entry, log)) + '\n')
     
     print(f"\nTotal changes made: {changes_made}")
     print(f"Output written to: {output_file}")
@@ -156,7 +193,7 @@ if __name__ == '__main__':
     print("=" * 60)
     print()
     
-    changes = apply_mapping(pcb_file, output_file)
+    changes = apply_mapping(pcb_file, output_file, verbose='--quiet' not in sys.argv[1:])
     
     if changes > 0:
         print("\n" + "=" * 60)
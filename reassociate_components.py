@@ -3,131 +3,300 @@
 Script to reassociate copied PCB components with U27's schematic circuit.
 """
 
+import mmap
 import re
 import os
-from collections import defaultdict
+import shutil
+import sys
+from contextlib import contextmanager, suppress
+from functools import lru_cache
 
-def parse_schematic_components(sch_file):
-    """Extract components from schematic that are above the sheet (negative Y)."""
-    with open(sch_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    components = []
+# google-re2 guarantees linear-time matching, but its per-call overhead makes
+# it slower than re on these many short searches, so it is opt-in via
+# REASSOCIATE_USE_RE2=1. None of the scanning patterns below use
+# backreferences or lookarounds, so either engine works.
+fast_re = re
+if os.environ.get('REASSOCIATE_USE_RE2') == '1':
+    try:
+        import re2 as fast_re
+    except ImportError:
+        pass
+
+# Output is written as many small segments; batch them into 1 MiB writes
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Schematic symbol fields, in the order KiCad writes them. Fields are read
+# positionally since re2 keys bytes pattern group names as bytes
+SYMBOL_RE = fast_re.compile(
+    rb'(?s)\(lib_id "(?P<lib_id>[^"]+)"\)'
+    rb'.*?\(at (?P<x>[0-9.-]+) (?P<y>[0-9.-]+)'
+    rb'.*?\(uuid "(?P<uuid>[a-f0-9-]+)"\)'
+    rb'.*?\(property "Reference" "(?P<reference>[^"]+)"'
+    rb'(?:.*?\(property "Footprint" "(?P<footprint>[^"]*)")?'
+)
+# PCB footprint header fields, in the order KiCad writes them. The header
+# always fits in the first HEADER_SPAN bytes of a footprint block; the
+# Reference property may follow a long (descr ...) so is searched separately.
+FOOTPRINT_RE = fast_re.compile(
+    rb'(?s)\(footprint "(?P<footprint>[^"]+)"'
+    rb'.*?\(uuid "(?P<uuid>[a-f0-9-]+)"\)'
+    rb'.*?\(at (?P<x>[0-9.-]+) (?P<y>[0-9.-]+)'
+)
+HEADER_SPAN = 1024
+REFERENCE_RE = fast_re.compile(rb'\(property "Reference" "([^"]+)"')
+UUID_RE = fast_re.compile(rb'\(uuid "([a-f0-9-]+)"\)')
+DIGIT_RE = re.compile(r'\d+')
+
+# Footprint categories in priority order: (type, any of these keywords, and
+# this keyword too if not None), matched against the lowercased footprint
+FOOTPRINT_TYPES = (
+    ('MCU', ('qfn', 'ep'), 'rp2350'),
+    ('CAP', ('capacitor', 'c_0'), None),
+    ('RES', ('resistor', 'r_0'), None),
+    ('LED', ('led',), None),
+    ('CRYSTAL', ('crystal',), None),
+    ('INDUCTOR', ('l_pol', 'inductor'), None),
+    ('SWITCH', ('sw_push', 'switch'), None),
+    ('CONNECTOR', ('pinheader', 'connector', 'conn'), None),
+)
+FOOTPRINT_TYPE_NAMES = tuple(fp_type for fp_type, _, _ in FOOTPRINT_TYPES) + ('OTHER',)
+
+# Reference substitution patterns, compiled once per PCB reference
+_ref_sub_patterns = {}
+
+
+def get_ref_sub_pattern(ref):
+    """Return the compiled pattern matching the Reference property of ref."""
+    pattern = _ref_sub_patterns.get(ref)
+    if pattern is None:
+        pattern = re.compile(rb'\(property "Reference" "' + re.escape(ref.encode()) + b'"')
+        _ref_sub_patterns[ref] = pattern
+    return pattern
+
+
+@lru_cache(maxsize=4096)
+def reference_number(reference):
+    """Return the first number in a reference designator, or 0 if it has none."""
+    num_match = DIGIT_RE.search(reference)
+    return int(num_match.group()) if num_match else 0
+
+
+class Component:
+    """A schematic symbol or PCB footprint instance.
+
+    prefix and num are parsed from the reference once, for sorting.
+    """
+    __slots__ = ('reference', 'lib_id', 'footprint', 'x', 'y', 'uuid', 'num', 'prefix')
     
-    # Split by symbol blocks - look for the pattern that starts a symbol instance
-    # Pattern: tab + (symbol + newline
-    parts = content.split('\n\t(symbol\n')
+    def __init__(self, reference, footprint, x, y, uuid, lib_id=None):
+        self.reference = reference
+        self.lib_id = lib_id
+        self.footprint = footprint
+        self.x = x
+        self.y = y
+        self.uuid = uuid
+        self.num = reference_number(reference)
+        self.prefix = reference[0]
+
+
+@contextmanager
+def map_file(path):
+    """Memory-map path read-only for the duration of the with block."""
+    with open(path, 'rb') as f:
+        # mmap refuses zero-length files; an empty file is just empty content.
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            yield content
+
+
+def write_edits(content, edits, output_file):
+    """Write content with (start, end, new_block) edits applied.
+
+    Unchanged segments are streamed straight from content. output_file may
+    be the file content is mapped from, so the result goes to a temporary file
+    next to it whose path is returned; the caller moves it into place with
+    finish_write() once content is unmapped. The temporary file sits beside
+    the symlink-resolved target so the final rename stays on one filesystem.
+    Raises ValueError if two edits overlap.
+    """
+    tmp_file = os.path.realpath(output_file) + '.tmp'
+    try:
+        with open(tmp_file, 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+            cursor = 0
+            for block_start, block_end, new_block in sorted(edits):
+                if block_start < cursor:
+                    raise ValueError(f"Overlapping edits at byte {block_start}")
+                out.write(content[cursor:block_start])
+                out.write(new_block)
+                cursor = block_end
+            out.write(content[cursor:])
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(tmp_file)
+        raise
+    return tmp_file
+
+
+def finish_write(tmp_file, output_file):
+    """Move a file written by write_edits() into place as output_file.
+
+    A symlinked output_file keeps its link and has its target updated, and an
+    existing target keeps its permission bits.
+    """
+    target = os.path.realpath(output_file)
+    try:
+        if os.path.exists(target):
+            shutil.copymode(target, tmp_file)
+        os.replace(tmp_file, target)
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(tmp_file)
+        raise
+
+
+def find_block_end(content, start):
+    """Return the index just past the parenthesised block opened at start.
+
+    Walks from one paren to the next with str.find rather than stepping
+    through every character. Returns start if the block is never closed.
+    """
+    depth = 0
+    next_open = content.find(b'(', start)
+    next_close = content.find(b')', start)
+    while next_close != -1:
+        if next_open != -1 and next_open < next_close:
+            depth += 1
+            next_open = content.find(b'(', next_open + 1)
+        else:
+            depth -= 1
+            if depth == 0:
+                return next_close + 1
+            next_close = content.find(b')', next_close + 1)
+    return start
+
+
+def iter_blocks(content, delimiter):
+    """Yield (start, end) spans of the top-level blocks opened by delimiter.
+
+    The delimiter starts with a newline and a one-tab indent; each block ends
+    at the first closing paren back at that indent. No block is copied.
+    """
+    pos = content.find(delimiter)
+    while pos != -1:
+        start = pos + 1
+        end = content.find(b'\n\t)', start)
+        end = len(content) if end == -1 else end + 3
+        yield start, end
+        pos = content.find(delimiter, end)
+
+
+def locate_uuid_blocks(content, uuids):
+    """Map each UUID in the set uuids to the span of the footprint it first appears in.
+
+    All UUIDs are found in a single pass over the (uuid "...") entries. A UUID
+    maps to None if its first occurrence is not inside a footprint block, and
+    is left out if it does not occur at all.
+    """
+    spans = {}
+    if not uuids:
+        return spans
     
-    for i, part in enumerate(parts[1:], 1):  # Skip first part (before any symbol)
-        block = '\t(symbol\n' + part.split('\n\t)\n\t(symbol\n')[0]
-        
-        # Check for lib_name (indicates it's a library symbol copy, not definition)
-        if '(lib_name ' not in block and '(lib_id ' not in block:
+    for match in UUID_RE.finditer(content):
+        uuid = match.group(1).decode()
+        if uuid not in uuids or uuid in spans:
             continue
         
-        # Extract lib_id
-        lib_match = re.search(r'\(lib_id "([^"]+)"\)', block)
-        if not lib_match:
-            continue
-        lib_id = lib_match.group(1)
+        # Find the enclosing footprint block (search backward for (footprint)
+        block_start = content.rfind(b'\n\t(footprint "', 0, match.start()) + 1
+        block_end = find_block_end(content, block_start) if block_start else 0
+        spans[uuid] = (block_start, block_end) if match.start() < block_end else None
         
-        # Extract position from (at X Y) - first occurrence
-        at_match = re.search(r'\(at ([0-9.-]+) ([0-9.-]+)', block)
-        if not at_match:
+        if len(spans) == len(uuids):
+            break
+    
+    return spans
+
+
+def parse_schematic_components(content):
+    """Extract components from schematic content that are above the sheet (negative Y)."""
+    components = []
+    
+    # Walk symbol instance blocks - each starts with tab + (symbol + newline
+    for start, end in iter_blocks(content, b'\n\t(symbol\n'):
+        # Extract lib_id, position, UUID, reference and footprint in one pass
+        match = SYMBOL_RE.search(content, start, end)
+        if not match:
             continue
-        x, y = float(at_match.group(1)), float(at_match.group(2))
+        lib_id, x, y, uuid, reference, footprint = match.groups()
+        x, y = float(x), float(y)
         
         # Only keep components with negative Y (above sheet)
         if y >= 0:
             continue
-            
-        # Extract UUID
-        uuid_match = re.search(r'\(uuid "([a-f0-9-]+)"\)', block)
-        if not uuid_match:
-            continue
-        uuid = uuid_match.group(1)
         
-        # Extract Reference
-        ref_match = re.search(r'\(property "Reference" "([^"]+)"', block)
-        if not ref_match:
-            continue
-        reference = ref_match.group(1)
+        reference = reference.decode()
         
         # Skip power symbols by reference
         if reference.startswith('#'):
             continue
-            
-        # Extract footprint
-        fp_match = re.search(r'\(property "Footprint" "([^"]+)"', block)
-        footprint = fp_match.group(1) if fp_match else ""
         
-        components.append({
-            'reference': reference,
-            'lib_id': lib_id,
-            'footprint': footprint,
-            'x': x,
-            'y': y,
-            'uuid': uuid
-        })
+        lib_id = lib_id.decode()
+        uuid = uuid.decode()
+        footprint = footprint.decode() if footprint else ""
+        
+        components.append(Component(
+            reference=reference,
+            lib_id=lib_id,
+            footprint=footprint,
+            x=x,
+            y=y,
+            uuid=uuid,
+        ))
     
     return components
 
 
-def parse_pcb_components(pcb_file):
-    """Extract footprints from PCB that are in the copied area (Y < 180) and unlinked."""
-    with open(pcb_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
+def parse_pcb_components(content):
+    """Extract footprints from PCB content that are in the copied area (Y < 180) and unlinked."""
     components = []
     
-    # Split by footprint blocks
-    parts = content.split('\n\t(footprint "')
-    
-    for i, part in enumerate(parts[1:], 1):
-        block = '\t(footprint "' + part.split('\n\t)\n\t(footprint "')[0]
-        
-        # Extract footprint type
-        fp_match = re.search(r'\(footprint "([^"]+)"', block)
-        if not fp_match:
+    for start, end in iter_blocks(content, b'\n\t(footprint "'):
+        # Extract footprint type, UUID and position from the block header
+        match = FOOTPRINT_RE.match(content, start + 1, min(end, start + HEADER_SPAN))
+        if not match:
             continue
-        footprint = fp_match.group(1)
-        
-        # Extract position - look for (at X Y in the block header area
-        at_match = re.search(r'\(at ([0-9.-]+) ([0-9.-]+)', block)
-        if not at_match:
-            continue
-        x, y = float(at_match.group(1)), float(at_match.group(2))
+        footprint, uuid, x, y = match.groups()
+        x, y = float(x), float(y)
         
         # Only keep components in copied area (Y < 180)
         if y >= 180:
             continue
-            
-        # Extract UUID
-        uuid_match = re.search(r'\(uuid "([a-f0-9-]+)"\)', block)
-        if not uuid_match:
-            continue
-        uuid = uuid_match.group(1)
         
         # Extract Reference
-        ref_match = re.search(r'\(property "Reference" "([^"]+)"', block)
+        ref_match = REFERENCE_RE.search(content, match.end(), end)
         if not ref_match:
             continue
-        reference = ref_match.group(1)
+        
+        footprint = footprint.decode()
+        uuid = uuid.decode()
+        reference = ref_match.group(1).decode()
         
         # Check if it has a path (linked to schematic)
-        has_path = bool(re.search(r'\(path "/[a-f0-9-]+"\)', block))
+        has_path = content.find(b'(path "/', start, end) != -1
         
         # Only get unlinked components
         if has_path:
             continue
         
-        components.append({
-            'reference': reference,
-            'footprint': footprint,
-            'x': x,
-            'y': y,
-            'uuid': uuid,
-        })
+        components.append(Component(
+            reference=reference,
+            footprint=footprint,
+            x=x,
+            y=y,
+            uuid=uuid,
+        ))
     
     return components
 
@@ -135,77 +304,91 @@ def parse_pcb_components(pcb_file):
 def get_footprint_type(footprint):
     """Categorize footprint by type."""
     fp_lower = footprint.lower()
-    if 'rp2350' in fp_lower and ('qfn' in fp_lower or 'ep' in fp_lower):
-        return 'MCU'
-    if 'capacitor' in fp_lower or 'c_0' in fp_lower:
-        return 'CAP'
-    if 'resistor' in fp_lower or 'r_0' in fp_lower:
-        return 'RES'
-    if 'led' in fp_lower:
-        return 'LED'
-    if 'crystal' in fp_lower:
-        return 'CRYSTAL'
-    if 'l_pol' in fp_lower or 'inductor' in fp_lower:
-        return 'INDUCTOR'
-    if 'sw_push' in fp_lower or 'switch' in fp_lower:
-        return 'SWITCH'
-    if 'pinheader' in fp_lower or 'connector' in fp_lower or 'conn' in fp_lower:
-        return 'CONNECTOR'
+    for fp_type, keywords, required in FOOTPRINT_TYPES:
+        if required is not None and required not in fp_lower:
+            continue
+        for keyword in keywords:
+            if keyword in fp_lower:
+                return fp_type
     return 'OTHER'
 
 
-def create_mapping(sch_components, pcb_components):
-    """Create a mapping from PCB components to schematic components based on footprint type."""
+def format_log_entry(entry):
+    """Format a ('type' | 'match' | 'extra', ...) entry logged by create_mapping."""
+    kind = entry[0]
+    if kind == 'type':
+        return f"\n{entry[1]}: {entry[2]} schematic, {entry[3]} PCB"
+    if kind == 'match':
+        return f"  {entry[1]} -> {entry[2]}"
+    return f"  {entry[1]} -> NO MATCH (extra PCB component)"
+
+
+def create_mapping(sch_components, pcb_components, verbose=True):
+    """Create a mapping from PCB components to schematic components based on footprint type.
+
+    The per-type matches are printed in one write at the end, or not at all if
+    verbose is False.
+    """
     
     # Group by footprint type
-    sch_by_type = defaultdict(list)
-    pcb_by_type = defaultdict(list)
+    sch_by_type = {fp_type: [] for fp_type in FOOTPRINT_TYPE_NAMES}
+    pcb_by_type = {fp_type: [] for fp_type in FOOTPRINT_TYPE_NAMES}
     
     for comp in sch_components:
-        fp_type = get_footprint_type(comp['footprint'])
+        fp_type = get_footprint_type(comp.footprint)
         sch_by_type[fp_type].append(comp)
     
     for comp in pcb_components:
-        fp_type = get_footprint_type(comp['footprint'])
+        fp_type = get_footprint_type(comp.footprint)
         pcb_by_type[fp_type].append(comp)
     
     # Sort each group by reference number for consistent mapping
-    for fp_type in sch_by_type:
-        sch_by_type[fp_type].sort(key=lambda x: (x['reference'][0], int(re.search(r'\d+', x['reference']).group()) if re.search(r'\d+', x['reference']) else 0))
+    for comps in sch_by_type.values():
+        comps.sort(key=lambda x: (x.prefix, x.num))
     
-    for fp_type in pcb_by_type:
-        pcb_by_type[fp_type].sort(key=lambda x: (x['reference'][0], int(re.search(r'\d+', x['reference']).group()) if re.search(r'\d+', x['reference']) else 0))
+    for comps in pcb_by_type.values():
+        comps.sort(key=lambda x: (x.prefix, x.num))
     
     mapping = []
+    log = []
     
-    for fp_type in set(list(sch_by_type.keys()) + list(pcb_by_type.keys())):
-        sch_list = sch_by_type.get(fp_type, [])
-        pcb_list = pcb_by_type.get(fp_type, [])
+    for fp_type in FOOTPRINT_TYPE_NAMES:
+        sch_list = sch_by_type[fp_type]
+        pcb_list = pcb_by_type[fp_type]
+        if not sch_list and not pcb_list:
+            continue
         
-        print(f"\n{fp_type}: {len(sch_list)} schematic, {len(pcb_list)} PCB")
+        log.append(('type', fp_type, len(sch_list), len(pcb_list)))
         
         # Match by position in sorted list
         for i, pcb_comp in enumerate(pcb_list):
             if i < len(sch_list):
                 sch_comp = sch_list[i]
                 mapping.append({
-                    'pcb_ref': pcb_comp['reference'],
-                    'pcb_uuid': pcb_comp['uuid'],
-                    'sch_ref': sch_comp['reference'],
-                    'sch_uuid': sch_comp['uuid'],
+                    'pcb_ref': pcb_comp.reference,
+                    'pcb_uuid': pcb_comp.uuid,
+                    'sch_ref': sch_comp.reference,
+                    'sch_uuid': sch_comp.uuid,
                     'footprint_type': fp_type
                 })
-                print(f"  {pcb_comp['reference']} -> {sch_comp['reference']}")
+                log.append(('match', pcb_comp.reference, sch_comp.reference))
             else:
-                print(f"  {pcb_comp['reference']} -> NO MATCH (extra PCB component)")
+                log.append(('extra', pcb_comp.reference))
+    
+    if verbose and log:
+        sys.stdout.write('\n'.join(map(format_log_entry, log)) + '\n')
     
     return mapping
 
 
-def apply_mapping_to_pcb(pcb_file, mapping, output_file):
-    """Apply the mapping to create a new PCB file with reassociated components."""
-    with open(pcb_file, 'r', encoding='utf-8') as f:
-        content = f.read()
+def build_pcb_edits(content, mapping):
+    """Return the (start, end, new_block) edits that apply mapping to PCB content."""
+    # Locate the footprint block of every mapped UUID in one scan
+    uuid_to_block = locate_uuid_blocks(content, {m['pcb_uuid'] for m in mapping})
+    
+    # New block text by span; entries resolving to an already edited block
+    # (e.g. a UUID shared by two footprints) build on that edit
+    edits = {}
     
     for m in mapping:
         pcb_uuid = m['pcb_uuid']
@@ -214,67 +397,51 @@ def apply_mapping_to_pcb(pcb_file, mapping, output_file):
         new_ref = m['sch_ref']
         
         # Find the footprint block by UUID
-        # Pattern: (uuid "pcb_uuid")
-        uuid_pattern = f'(uuid "{pcb_uuid}")'
-        
-        if uuid_pattern not in content:
+        if pcb_uuid not in uuid_to_block:
             print(f"WARNING: Could not find UUID {pcb_uuid} in PCB file")
             continue
-        
-        # Find the start of this footprint block
-        uuid_pos = content.find(uuid_pattern)
-        
-        # Find the footprint block start (search backward for (footprint)
-        block_start = content.rfind('\t(footprint "', 0, uuid_pos)
-        if block_start == -1:
+        span = uuid_to_block[pcb_uuid]
+        if span is None:
             print(f"WARNING: Could not find footprint block start for {pcb_uuid}")
             continue
         
-        # Find the end of this footprint block
-        # Count parentheses to find matching close
-        depth = 0
-        block_end = block_start
-        for i, char in enumerate(content[block_start:], block_start):
-            if char == '(':
-                depth += 1
-            elif char == ')':
-                depth -= 1
-                if depth == 0:
-                    block_end = i + 1
-                    break
-        
-        old_block = content[block_start:block_end]
+        old_block = edits.get(span)
+        if old_block is None:
+            old_block = content[span[0]:span[1]]
         new_block = old_block
         
         # 1. Change reference
-        new_block = re.sub(
-            rf'\(property "Reference" "{re.escape(old_ref)}"',
-            f'(property "Reference" "{new_ref}"',
+        new_block = get_ref_sub_pattern(old_ref).sub(
+            f'(property "Reference" "{new_ref}"'.encode(),
             new_block
         )
         
         # 2. Add path and sheetinfo if not present
-        if '(path "/' not in new_block:
+        if b'(path "/' not in new_block:
             # Find position after (attr ...) or before first (fp_line
             # Insert path, sheetname, sheetfile
-            insert_text = f'\n\t\t(path "/{sch_uuid}")\n\t\t(sheetname "/")\n\t\t(sheetfile "isoSPI-M3Y-BMS-PCB.kicad_sch")'
+            insert_text = f'\n\t\t(path "/{sch_uuid}")\n\t\t(sheetname "/")\n\t\t(sheetfile "isoSPI-M3Y-BMS-PCB.kicad_sch")'.encode()
             
             # Find a good insertion point - after (attr ...) line
-            attr_match = re.search(r'\(attr [^\)]+\)', new_block)
-            if attr_match:
-                insert_pos = attr_match.end()
-                new_block = new_block[:insert_pos] + insert_text + new_block[insert_pos:]
+            attr_pos = new_block.find(b'(attr ')
+            if attr_pos != -1:
+                insert_pos = new_block.find(b')', attr_pos) + 1
             else:
                 # Try inserting before first (fp_line
-                fp_line_match = re.search(r'\n\t\t\(fp_line', new_block)
-                if fp_line_match:
-                    insert_pos = fp_line_match.start()
-                    new_block = new_block[:insert_pos] + insert_text + new_block[insert_pos:]
+                insert_pos = new_block.find(b'\n\t\t(fp_line')
+            if insert_pos > 0:
+                new_block = new_block[:insert_pos] + insert_text + new_block[insert_pos:]
         
-        content = content[:block_start] + new_block + content[block_end:]
+        edits[span] = new_block
     
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(content)
+    return [span + (new_block,) for span, new_block in edits.items()]
+
+
+def apply_mapping_to_pcb(pcb_file, mapping, output_file):
+    """Apply the mapping to create a new PCB file with reassociated components."""
+    with map_file(pcb_file) as content:
+        tmp_file = write_edits(content, build_pcb_edits(content, mapping), output_file)
+    finish_write(tmp_file, output_file)
     
     print(f"\nWrote updated PCB to: {output_file}")
 
@@ -283,38 +450,49 @@ if __name__ == '__main__':
     sch_file = 'isoSPI-M3Y-BMS-PCB.kicad_sch'
     pcb_file = 'isoSPI-M3Y-BMS-PCB.kicad_pcb'
     output_file = 'isoSPI-M3Y-BMS-PCB.kicad_pcb'  # Overwrite original
+    verbose = '--quiet' not in sys.argv[1:]
+    tmp_file = None
     
-    print("=" * 60)
-    print("Parsing schematic components (above sheet)...")
-    print("=" * 60)
-    sch_components = parse_schematic_components(sch_file)
-    
-    print(f"Found {len(sch_components)} schematic components above sheet:")
-    for comp in sorted(sch_components, key=lambda x: x['reference']):
-        print(f"  {comp['reference']:10} | {comp['footprint'][:50]}")
-    
-    print("\n" + "=" * 60)
-    print("Parsing PCB components (copied area, unlinked)...")
-    print("=" * 60)
-    pcb_components = parse_pcb_components(pcb_file)
-    
-    print(f"Found {len(pcb_components)} unlinked PCB components:")
-    for comp in sorted(pcb_components, key=lambda x: x['reference']):
-        print(f"  {comp['reference']:10} | {comp['footprint'][:50]}")
-    
-    print("\n" + "=" * 60)
-    print("Creating mapping...")
-    print("=" * 60)
-    mapping = create_mapping(sch_components, pcb_components)
-    
-    print("\n" + "=" * 60)
-    print(f"Total mappings: {len(mapping)}")
-    print("=" * 60)
+    # The PCB is mapped once and shared by parsing and rewriting
+    with map_file(pcb_file) as pcb_content:
+        print("=" * 60)
+        print("Parsing schematic components (above sheet)...")
+        print("=" * 60)
+        with map_file(sch_file) as sch_content:
+            sch_components = parse_schematic_components(sch_content)
+        
+        print(f"Found {len(sch_components)} schematic components above sheet:")
+        if verbose:
+            for comp in sorted(sch_components, key=lambda x: x.reference):
+                print(f"  {comp.reference:10} | {comp.footprint[:50]}")
+        
+        print("\n" + "=" * 60)
+        print("Parsing PCB components (copied area, unlinked)...")
+        print("=" * 60)
+        pcb_components = parse_pcb_components(pcb_content)
+        
+        print(f"Found {len(pcb_components)} unlinked PCB components:")
+        if verbose:
+            for comp in sorted(pcb_components, key=lambda x: x.reference):
+                print(f"  {comp.reference:10} | {comp.footprint[:50]}")
+        
+        print("\n" + "=" * 60)
+        print("Creating mapping...")
+        print("=" * 60)
+        mapping = create_mapping(sch_components, pcb_components, verbose=verbose)
+        
+        print("\n" + "=" * 60)
+        print(f"Total mappings: {len(mapping)}")
+        print("=" * 60)
+        
+        # Ask for confirmation
+        response = input("\nApply mapping to PCB file? (yes/no): ")
+        if response.lower() == 'yes':
+            tmp_file = write_edits(pcb_content, build_pcb_edits(pcb_content, mapping), output_file)
     
-    # Ask for confirmation
-    response = input("\nApply mapping to PCB file? (yes/no): ")
-    if response.lower() == 'yes':
-        apply_mapping_to_pcb(pcb_file, mapping, output_file)
+    if tmp_file is not None:
+        finish_write(tmp_file, output_file)
+        print(f"\nWrote updated PCB to: {output_file}")
         print("\nDone! Please reload the PCB file in KiCad and run DRC to verify.")
     else:
         print("Aborted.")